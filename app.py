@@ -1,44 +1,84 @@
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
+from quart import Quart, request, jsonify, send_from_directory
+from quart_cors import cors, cors_exempt
+from hypercorn.middleware import ProxyFixMiddleware
 import openai
 from dotenv import load_dotenv
 import os
 import json
+import asyncio
 from back_office_handler import BackOfficeHandler
 import pandas as pd
 from db_handler import DatabaseHandler
 from back_office_handler import BackOfficeHandler
+from rate_limiter import RateLimiter
 
 # Load environment variables
 load_dotenv()
 
-app = Flask(__name__, static_url_path='', static_folder='.')
-CORS(app, resources={
-    r"/*": {
-        "origins": "*",
-        "methods": ["GET", "POST", "OPTIONS"],
-        "allow_headers": ["Content-Type"]
-    }
-})
+# ASGI app: run with `hypercorn app:app --bind 0.0.0.0:8000` so each worker
+# keeps one event loop that holds many in-flight chat turns
+app = Quart(__name__, static_url_path='', static_folder='.')
+# Number of reverse proxies in front of the app; their X-Forwarded-For gives the client address
+trusted_proxies = int(os.getenv('TRUSTED_PROXIES', '0'))
+if trusted_proxies:
+    app.asgi_app = ProxyFixMiddleware(app.asgi_app, mode='legacy', trusted_hops=trusted_proxies)
+app = cors(
+    app,
+    allow_origin=os.getenv('CORS_ORIGINS', 'http://localhost:8000,http://127.0.0.1:8000').split(','),
+    allow_methods=["GET", "POST", "OPTIONS"],
+    allow_headers=["Content-Type", "X-Session-ID"],
+    expose_headers=["Retry-After"]
+)
 db = DatabaseHandler()
 back_office = BackOfficeHandler()
 
+# Per-endpoint limits: token bucket per client/session plus a global in-flight cap
+rate_limiter = RateLimiter({
+    'chat': {
+        'rate': float(os.getenv('CHAT_RATE_PER_SECOND', '0.5')),
+        'burst': int(os.getenv('CHAT_BURST', '5')),
+        'max_in_flight': int(os.getenv('CHAT_MAX_IN_FLIGHT', '8')),
+        'max_queue': int(os.getenv('CHAT_MAX_QUEUE', '16')),
+        'queue_timeout': float(os.getenv('CHAT_QUEUE_TIMEOUT', '5'))
+    },
+    'reset': {
+        'rate': float(os.getenv('RESET_RATE_PER_SECOND', '1')),
+        'burst': int(os.getenv('RESET_BURST', '10')),
+        'max_in_flight': int(os.getenv('RESET_MAX_IN_FLIGHT', '32')),
+        'max_queue': int(os.getenv('RESET_MAX_QUEUE', '32')),
+        'queue_timeout': float(os.getenv('RESET_QUEUE_TIMEOUT', '1'))
+    }
+})
+
 @app.route('/<path:path>')
-def serve_static(path):
-    return send_from_directory('.', path)
+async def serve_static(path):
+    return await send_from_directory('.', path)
 
 @app.route('/')
-def serve_index():
+async def serve_index():
     # Reset context when serving the main page
     reset_conversation_context()
-    return send_from_directory('.', 'index.html')
+    return await send_from_directory('.', 'index.html')
 
 @app.route('/api/reset', methods=['POST'])
-def reset():
+@rate_limiter.limit('reset')
+async def reset():
     """Reset the conversation context"""
     reset_conversation_context()
     return jsonify({'status': 'success'})
 
+# Addresses allowed to read /api/metrics. Behind a proxy, set TRUSTED_PROXIES
+# too, or every request looks local.
+metrics_allowed_addrs = os.getenv('METRICS_ALLOWED_ADDRS', '127.0.0.1,::1').split(',')
+
+@app.route('/api/metrics', methods=['GET'])
+@cors_exempt
+async def metrics():
+    """Admission control counters (admitted, queued, shed) per endpoint"""
+    if request.remote_addr not in metrics_allowed_addrs:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(rate_limiter.get_metrics())
+
 def reset_conversation_context():
     """Reset the conversation context to initial state"""
     get_conversation_context.context = {
@@ -76,6 +116,16 @@ if not api_key:
     raise ValueError("OpenAI API key not found in environment variables")
 
 client = openai.OpenAI(api_key=api_key)
+# Shared across turns: the ASGI server runs one long-lived event loop per
+# worker, so the connection pool is reused between requests
+async_client = openai.AsyncOpenAI(api_key=api_key)
+
+# Cap on speculative storage reads running at once, so prefetching backs off
+# instead of competing with real lookups for worker threads under load
+prefetch_slots = asyncio.BoundedSemaphore(int(os.getenv('PREFETCH_MAX_IN_FLIGHT', '4')))
+
+# Unused prefetches still running; held so their tasks aren't garbage collected
+ignored_prefetches = set()
 
 def get_back_office_response(dispute_id, transaction_id, user_id):
     system_prompt = """
@@ -193,15 +243,77 @@ def get_new_dispute_prompt(context):
     }}
     """.format(context)
 
-def process_message(message, context):
-    # If we're in dispute status flow or message indicates status check
-    is_status_check = (
+def is_status_check_message(message, context):
+    """Check if we're in dispute status flow or the message indicates a status check"""
+    return bool(
         (context and context.get('intent') == 'Dispute Status') or
         any(word in message.lower() for word in ['status', 'check', 'track', 'progress'])
     )
-    
+
+def extract_dispute_id(message):
+    """Get the dispute ID from a selected dispute option, if any"""
+    if '(ID:' in message:
+        return message.split('(ID:')[1].strip().rstrip(')')
+    return None
+
+async def start_prefetch(message, context):
+    """Speculatively start storage lookups the turn is likely to need.
+
+    Runs while the model call is in flight. Each task is keyed by the
+    lookup and its arguments so a prefetch is only used if the turn ends
+    up asking for exactly the same data. Lookups are skipped when all
+    prefetch slots are busy; the turn then fetches on demand.
+    """
+    lookups = {}
+    dispute_id = extract_dispute_id(message) or context.get('dispute_id')
+    if dispute_id:
+        lookups[('case_status', dispute_id)] = (back_office.get_case_status, dispute_id)
+    elif is_status_check_message(message, context):
+        lookups[('disputes',)] = (db.get_all_disputes,)
+    elif not context.get('transaction_id'):
+        lookups[('transactions',)] = (db.get_all_transactions,)
+
+    prefetches = {}
+    for key, call in lookups.items():
+        if prefetch_slots.locked():
+            print(f"Skipping prefetch {key}: prefetch slots busy")
+            continue
+        # Doesn't block: a slot is free and nothing else runs before we take it
+        await prefetch_slots.acquire()
+        task = asyncio.create_task(asyncio.to_thread(*call))
+        # Done callbacks run however the task ends, even if it never started
+        task.add_done_callback(lambda _: prefetch_slots.release())
+        prefetches[key] = task
+    return prefetches
+
+async def take_prefetch(prefetches, key, func, *args):
+    """Use a matching prefetch if one was started, otherwise fetch now"""
+    task = prefetches.pop(key, None)
+    if task is not None:
+        print(f"Using prefetched {key}")
+        return await task
+    return await asyncio.to_thread(func, *args)
+
+def ignore_prefetch(task):
+    """Let an unused prefetch finish in the background and drop its result.
+
+    The read keeps its prefetch slot until it completes, so unused reads
+    still count against PREFETCH_MAX_IN_FLIGHT. The response does not wait
+    for it.
+    """
+    ignored_prefetches.add(task)
+    task.add_done_callback(ignored_prefetches.discard)
+
+def discard_prefetch(prefetches):
+    """Ignore the results of prefetches the turn did not use"""
+    for key, task in prefetches.items():
+        print(f"Ignoring unused prefetch {key}")
+        ignore_prefetch(task)
+    prefetches.clear()
+
+async def process_message(message, context):
     # Choose appropriate prompt based on context
-    if is_status_check:
+    if is_status_check_message(message, context):
         system_prompt = get_dispute_status_prompt(context)
     else:
         system_prompt = get_new_dispute_prompt(context)
@@ -211,7 +323,7 @@ def process_message(message, context):
         # Format user message separately to avoid nested f-strings
         user_message = "Context: " + str(context) + "\nUser message: " + message
         
-        response = client.chat.completions.create(
+        response = await async_client.chat.completions.create(
             model="gpt-4",
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -250,10 +362,12 @@ def process_message(message, context):
         }
 
 @app.route('/api/chat', methods=['POST'])
-def chat():
+@rate_limiter.limit('chat')
+async def chat():
+    prefetches = {}
     try:
         print("Received chat request")
-        data = request.json
+        data = await request.get_json()
         print(f"Request data: {data}")
         user_message = data.get('message', '')
         print(f"User message: {user_message}")
@@ -261,9 +375,12 @@ def chat():
         # Get current conversation context
         context = get_conversation_context(None)
         
+        # Start likely storage lookups so they overlap with the model call
+        prefetches = await start_prefetch(user_message, context)
+
         # Process the message with context
         print(f"Processing message with context: {context}")
-        result = process_message(user_message, context)
+        result = await process_message(user_message, context)
         print(f"Process result: {result}")
         
         # Handle concluding statements by resetting context
@@ -278,8 +395,8 @@ def chat():
             ctx = get_conversation_context(None)
             
             # Extract dispute ID from user selection
-            if '(ID:' in user_message:
-                dispute_id = user_message.split('(ID:')[1].strip().rstrip(')')
+            dispute_id = extract_dispute_id(user_message)
+            if dispute_id:
                 print(f"Extracted dispute ID: {dispute_id}")
                 ctx['dispute_id'] = dispute_id  # Update context immediately
                 result['context_updates'] = {'dispute_id': dispute_id, 'intent': 'Dispute Status'}
@@ -299,8 +416,10 @@ def chat():
                     print(f"Looking up dispute with ID: {dispute_id}")
                     
                     # Get back office case details and outcome message directly
-                    back_office = BackOfficeHandler()
-                    case_dict, outcome = back_office.get_case_status(dispute_id=dispute_id)
+                    case_dict, outcome = await take_prefetch(
+                        prefetches, ('case_status', dispute_id),
+                        back_office.get_case_status, dispute_id
+                    )
                     print(f"Back office case details: {case_dict}")
                     
                     if not case_dict:
@@ -354,13 +473,18 @@ def chat():
                 missing_fields = [field for field in required_fields if field not in ctx.get('dispute_details', {})]
                 
                 if not missing_fields:
-                    dispute, message = db.create_dispute(
+                    dispute, message = await asyncio.to_thread(
+                        db.create_dispute,
                         ctx['transaction_id'],
                         ctx['dispute_type'],
                         ctx['dispute_details']
                     )
                     
                     if dispute:
+                        # A prefetched dispute list would miss the new dispute
+                        stale = prefetches.pop(('disputes',), None)
+                        if stale:
+                            ignore_prefetch(stale)
                         result['response'] = f"Dispute created successfully! Your dispute ID is: {dispute['dispute_id']}"
                         result['context_updates'] = {}  # Reset context after successful creation
                     else:
@@ -369,7 +493,7 @@ def chat():
         # Get transactions if needed
         transactions = None
         if result.get('show_transactions', False):
-            transactions = db.get_all_transactions()
+            transactions = await take_prefetch(prefetches, ('transactions',), db.get_all_transactions)
             # Format transactions for display
             transaction_options = [f"{t['merchant_seller']} - ${t['amount']} (ID: {t['transaction_id']})" for t in transactions]
             result['options'] = transaction_options
@@ -377,7 +501,7 @@ def chat():
         # Get disputes if needed
         disputes = None
         if result.get('show_disputes', False):
-            disputes = db.get_all_disputes()
+            disputes = await take_prefetch(prefetches, ('disputes',), db.get_all_disputes)
             # Format disputes for display
             dispute_options = [f"{d['merchant']} - ${d['amount']} ({d['type']}) (ID: {d['dispute_id']})" for d in disputes]
             result['options'] = dispute_options
@@ -406,5 +530,7 @@ def chat():
             'context_updates': {}
         })
         return response
+    finally:
+        discard_prefetch(prefetches)
 if __name__ == '__main__':
     app.run(port=8000, debug=True)
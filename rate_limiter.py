@@ -0,0 +1,220 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from functools import wraps
+
+from quart import request, jsonify
+
+# Least recently used buckets are evicted once this many clients/sessions are tracked
+MAX_TRACKED_BUCKETS = 10000
+
+# Weight of the newest request when averaging service time for Retry-After
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Refill the bucket; return seconds until a token is available (0 if one is)"""
+        elapsed = max(0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = max(self.updated, now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        """Take one token; return seconds until a token is available (0 if taken)"""
+        wait = self.wait_time(now)
+        if not wait:
+            self.tokens -= 1
+        return wait
+
+
+class EndpointLimiter:
+    """Limits for one endpoint.
+
+    All state lives on the server's event loop, so no locking is needed:
+    nothing here awaits between reading and updating a counter.
+    """
+
+    def __init__(self, name, rate, burst, max_in_flight, max_queue, queue_timeout):
+        if rate <= 0:
+            raise ValueError(f"{name}: rate must be greater than 0")
+        if burst < 1:
+            raise ValueError(f"{name}: burst must be at least 1")
+        if max_in_flight < 1:
+            raise ValueError(f"{name}: max_in_flight must be at least 1")
+        if max_queue < 0 or queue_timeout < 0:
+            raise ValueError(f"{name}: max_queue and queue_timeout cannot be negative")
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.buckets = OrderedDict()
+        self.in_flight = 0
+        self.waiters = deque()
+        self.avg_service_time = None
+        self.metrics = {'admitted': 0, 'queued': 0, 'shed_rate_limited': 0, 'shed_overloaded': 0}
+
+    def check_rate(self, keys):
+        """Charge every key's bucket, but only if none is empty; return the wait.
+
+        Keys are checked in order and checking stops at the first empty
+        bucket, so later keys (the client-chosen session ID) only get a
+        bucket once the earlier ones (the client address) would admit.
+        """
+        now = time.monotonic()
+        buckets = []
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self.buckets) > MAX_TRACKED_BUCKETS:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            retry_after = bucket.wait_time(now)
+            if retry_after:
+                self.metrics['shed_rate_limited'] += 1
+                return retry_after
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.consume(now)
+        return 0
+
+    async def acquire(self):
+        """Take an in-flight slot, waiting in the bounded queue if needed"""
+        if self.in_flight < self.max_in_flight and not self.waiters:
+            self.in_flight += 1
+            self.metrics['admitted'] += 1
+            return True
+        if len(self.waiters) >= self.max_queue:
+            self.metrics['shed_overloaded'] += 1
+            return False
+
+        # release() hands its slot straight to the oldest waiter
+        handoff = asyncio.get_running_loop().create_future()
+        self.waiters.append(handoff)
+        self.metrics['queued'] += 1
+        try:
+            await asyncio.wait_for(handoff, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.metrics['shed_overloaded'] += 1
+            return False
+        except asyncio.CancelledError:
+            # A slot handed over just as we were cancelled must be passed on
+            if handoff.done() and not handoff.cancelled():
+                self.free_slot()
+            raise
+        finally:
+            if handoff in self.waiters:
+                self.waiters.remove(handoff)
+        self.metrics['admitted'] += 1
+        return True
+
+    def free_slot(self):
+        """Hand an in-flight slot to the oldest live waiter, or give it back"""
+        while self.waiters:
+            handoff = self.waiters.popleft()
+            if not handoff.done():
+                handoff.set_result(True)
+                return
+        self.in_flight -= 1
+
+    def release(self, started):
+        """Give back an in-flight slot and record how long it was held"""
+        duration = time.monotonic() - started
+        if self.avg_service_time is None:
+            self.avg_service_time = duration
+        else:
+            self.avg_service_time += SERVICE_TIME_SMOOTHING * (duration - self.avg_service_time)
+        self.free_slot()
+
+    def overload_retry_after(self):
+        """Estimate when a slot frees up: the waiting requests drain at
+        max_in_flight per average service time"""
+        if self.avg_service_time is None:
+            return self.queue_timeout
+        return self.avg_service_time * (len(self.waiters) + 1) / self.max_in_flight
+
+    def snapshot(self):
+        """Get current counters and gauges for this endpoint"""
+        stats = dict(self.metrics)
+        stats['in_flight'] = self.in_flight
+        stats['waiting'] = len(self.waiters)
+        return stats
+
+
+class RateLimiter:
+    def __init__(self, limits):
+        """limits maps an endpoint name to its EndpointLimiter settings"""
+        self.endpoints = {
+            name: EndpointLimiter(name, **settings) for name, settings in limits.items()
+        }
+
+    def client_keys(self):
+        """Get the bucket keys for the current request: client address and session.
+
+        Behind a reverse proxy remote_addr is the proxy's address, so set
+        TRUSTED_PROXIES to have ProxyFix restore the real client address.
+        """
+        keys = ['client:' + (request.remote_addr or 'unknown')]
+        session_id = request.headers.get('X-Session-ID')
+        if session_id:
+            keys.append('session:' + session_id)
+        return keys
+
+    def shed(self, status, message, retry_after):
+        response = jsonify({
+            'intent': 'Error',
+            'response': message,
+            'options': [],
+            'context_updates': {}
+        })
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+        return response
+
+    def limit(self, name):
+        """Decorator applying rate limiting and admission control to a route"""
+        endpoint = self.endpoints[name]
+
+        def decorator(view):
+            @wraps(view)
+            async def wrapper(*args, **kwargs):
+                rejected = self.check_rate(name, endpoint)
+                if rejected:
+                    return rejected
+                if not await endpoint.acquire():
+                    return self.overloaded(name, endpoint)
+                started = time.monotonic()
+                try:
+                    return await view(*args, **kwargs)
+                finally:
+                    endpoint.release(started)
+            return wrapper
+        return decorator
+
+    def check_rate(self, name, endpoint):
+        """Get a 429 response if the client or session is over its rate, else None"""
+        retry_after = endpoint.check_rate(self.client_keys())
+        if retry_after:
+            print(f"Rate limited {name} request from {request.remote_addr}")
+            return self.shed(429, "You're sending messages too quickly. Please wait a moment and try again.", retry_after)
+        return None
+
+    def overloaded(self, name, endpoint):
+        print(f"Shedding {name} request: server at capacity")
+        return self.shed(503, "The assistant is busy right now. Please try again shortly.", endpoint.overload_retry_after())
+
+    def get_metrics(self):
+        """Get counters for all limited endpoints"""
+        return {name: endpoint.snapshot() for name, endpoint in self.endpoints.items()}
@@ -1,6 +1,18 @@
 // API base URL
 const API_BASE_URL = 'http://localhost:8000';
 
+// Per-tab session ID so the server can rate limit each conversation separately
+function getSessionId() {
+    let sessionId = sessionStorage.getItem('sessionId');
+    if (!sessionId) {
+        sessionId = window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        sessionStorage.setItem('sessionId', sessionId);
+    }
+    return sessionId;
+}
+
 // Function to add a message to the chat
 function addMessage(text, sender) {
     const chatMessages = document.getElementById('chatMessages');
@@ -50,7 +62,10 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // Reset conversation context
     fetch(`${API_BASE_URL}/api/reset`, {
-        method: 'POST'
+        method: 'POST',
+        headers: {
+            'X-Session-ID': getSessionId()
+        }
     }).then(() => {
         // Reset state panel
         updateStatePanel({
@@ -192,6 +207,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-Session-ID': getSessionId()
                 },
                 body: JSON.stringify({ message })
             });
@@ -200,6 +216,20 @@ document.addEventListener('DOMContentLoaded', () => {
             const responseText = await response.text();
             console.log('Response text:', responseText);
 
+            // Rate limited or server busy: show the server's message and keep the conversation state
+            if (response.status === 429 || response.status === 503) {
+                const retryAfter = response.headers.get('Retry-After');
+                console.log('Request shed, retry after (s):', retryAfter);
+                let busyMessage = 'The assistant is busy right now. Please try again shortly.';
+                try {
+                    busyMessage = JSON.parse(responseText).response || busyMessage;
+                } catch (parseError) {
+                    console.error('Error parsing shed response:', parseError);
+                }
+                addMessage(busyMessage, 'bot');
+                return;
+            }
+
             if (!response.ok) {
                 throw new Error(`Network response was not ok: ${response.status} ${responseText}`);
             }
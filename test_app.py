@@ -0,0 +1,150 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+
+import app as app_module
+
+TRANSACTIONS = [{'transaction_id': 'TX1', 'merchant_seller': 'Shop', 'amount': 10.0, 'date': '2024-01-01'}]
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(app_module, 'prefetch_slots', asyncio.BoundedSemaphore(2))
+    endpoint = app_module.rate_limiter.endpoints['chat']
+    monkeypatch.setattr(endpoint, 'buckets', type(endpoint.buckets)())
+    app_module.reset_conversation_context()
+    yield
+    app_module.reset_conversation_context()
+
+
+def stub_model(monkeypatch, result):
+    """Replace the model call with one that returns at once, without yielding"""
+    async def fake_process_message(message, context):
+        return dict(result)
+    monkeypatch.setattr(app_module, 'process_message', fake_process_message)
+
+
+def counting(result, delay=0):
+    """A storage lookup that records its calls"""
+    def lookup(*args):
+        lookup.calls += 1
+        time.sleep(delay)
+        return result() if callable(result) else result
+    lookup.calls = 0
+    return lookup
+
+
+async def post(client, message, session='s1'):
+    response = await client.post('/api/chat', json={'message': message}, headers={'X-Session-ID': session})
+    return await response.get_json()
+
+
+async def settle():
+    """Wait for ignored prefetches to finish"""
+    while app_module.ignored_prefetches:
+        await asyncio.sleep(0.01)
+
+
+def free_slots():
+    return app_module.prefetch_slots._value
+
+
+def test_prefetched_transactions_are_used(monkeypatch):
+    lookup = counting(TRANSACTIONS)
+    monkeypatch.setattr(app_module.db, 'get_all_transactions', lookup)
+    stub_model(monkeypatch, {'intent': 'File New Dispute', 'response': 'pick', 'show_transactions': True})
+
+    async def scenario():
+        return await post(app_module.app.test_client(), 'I want to file a dispute')
+
+    body = asyncio.run(scenario())
+    assert lookup.calls == 1
+    assert body['options'] == ['Shop - $10.0 (ID: TX1)']
+    assert free_slots() == 2
+
+
+def test_unused_prefetch_is_not_awaited_and_frees_its_slot(monkeypatch):
+    lookup = counting(TRANSACTIONS, delay=0.3)
+    monkeypatch.setattr(app_module.db, 'get_all_transactions', lookup)
+    stub_model(monkeypatch, {'intent': 'File New Dispute', 'response': 'which type?'})
+
+    async def scenario():
+        started = time.monotonic()
+        await post(app_module.app.test_client(), 'hello')
+        elapsed = time.monotonic() - started
+        # The unused read still holds its slot until it finishes
+        held = free_slots()
+        await settle()
+        return elapsed, held
+
+    elapsed, held = asyncio.run(scenario())
+    assert elapsed < 0.3
+    assert held == 1
+    assert free_slots() == 2
+
+
+def test_prefetch_slots_survive_model_calls_that_never_yield(monkeypatch):
+    lookup = counting(TRANSACTIONS)
+    monkeypatch.setattr(app_module.db, 'get_all_transactions', lookup)
+    stub_model(monkeypatch, {'intent': 'File New Dispute', 'response': 'which type?'})
+
+    async def scenario():
+        client = app_module.app.test_client()
+        for i in range(5):
+            await post(client, 'hello', session=f's{i}')
+            await settle()
+        return free_slots()
+
+    assert asyncio.run(scenario()) == 2
+    assert lookup.calls == 5
+
+
+def test_new_dispute_invalidates_prefetched_dispute_list(monkeypatch):
+    created = []
+    disputes = counting(lambda: [
+        {'dispute_id': d, 'merchant': 'Shop', 'amount': 10.0, 'type': 'INR', 'status': 'open'}
+        for d in created
+    ])
+    monkeypatch.setattr(app_module.db, 'get_all_disputes', disputes)
+
+    def create_dispute(transaction_id, dispute_type, details):
+        created.append('DSPNEW')
+        return {'dispute_id': 'DSPNEW'}, 'Dispute created successfully'
+    monkeypatch.setattr(app_module.db, 'create_dispute', create_dispute)
+
+    app_module.update_conversation_context({
+        'transaction_id': 'TX1',
+        'dispute_type': 'INR',
+        'dispute_details': {'expected_delivery_date': '2024-01-05', 'contacted_seller': 'Yes'}
+    })
+    stub_model(monkeypatch, {'intent': 'File New Dispute', 'response': 'done', 'show_disputes': True})
+
+    async def scenario():
+        body = await post(app_module.app.test_client(), 'check and submit')
+        await settle()
+        return body
+
+    body = asyncio.run(scenario())
+    assert disputes.calls == 2
+    assert body['options'] == ['Shop - $10.0 (INR) (ID: DSPNEW)']
+
+
+def test_process_message_reuses_shared_client(monkeypatch):
+    def no_new_clients(*args, **kwargs):
+        raise AssertionError("process_message must reuse the module-level client")
+    monkeypatch.setattr(app_module.openai, 'AsyncOpenAI', no_new_clients)
+
+    class Completion:
+        def __init__(self, content):
+            self.choices = [type('Choice', (), {'message': type('Message', (), {'content': content})})]
+
+    async def create(**kwargs):
+        return Completion('{"intent": "File New Dispute", "response": "ok"}')
+    monkeypatch.setattr(app_module.async_client.chat.completions, 'create', create)
+
+    result = asyncio.run(app_module.process_message('hello', {}))
+    assert result == {'intent': 'File New Dispute', 'response': 'ok'}
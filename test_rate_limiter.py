@@ -0,0 +1,233 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+os.environ.setdefault('OPENAI_API_KEY', 'test-key')
+
+import app as app_module
+import rate_limiter
+from rate_limiter import TokenBucket, EndpointLimiter
+
+
+def make_endpoint(**overrides):
+    settings = {
+        'rate': 1.0,
+        'burst': 2,
+        'max_in_flight': 1,
+        'max_queue': 1,
+        'queue_timeout': 0.05
+    }
+    settings.update(overrides)
+    return EndpointLimiter('test', **settings)
+
+
+def test_token_bucket_consume_and_refill():
+    bucket = TokenBucket(rate=2.0, capacity=2)
+    now = bucket.updated
+    assert bucket.consume(now) == 0
+    assert bucket.consume(now) == 0
+    assert bucket.consume(now) == pytest.approx(0.5)
+    # Half a second at 2 tokens/s refills one token
+    assert bucket.consume(now + 0.5) == 0
+
+
+def test_check_rate_does_not_debit_when_another_bucket_is_empty():
+    endpoint = make_endpoint(burst=1)
+    assert endpoint.check_rate(['client:a', 'session:s']) == 0
+    # Session is drained, so a fresh address is still rejected...
+    assert endpoint.check_rate(['client:b', 'session:s']) > 0
+    # ...without spending that address's token
+    assert endpoint.check_rate(['client:b']) == 0
+    assert endpoint.metrics['shed_rate_limited'] == 1
+
+
+def test_session_bucket_not_created_when_client_is_rate_limited():
+    endpoint = make_endpoint(burst=1)
+    assert endpoint.check_rate(['client:a', 'session:1']) == 0
+    for i in range(2, 100):
+        assert endpoint.check_rate(['client:a', f'session:{i}']) > 0
+    assert set(endpoint.buckets) == {'client:a', 'session:1'}
+
+
+def test_bucket_table_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'MAX_TRACKED_BUCKETS', 3)
+    endpoint = make_endpoint()
+    for key in ('client:a', 'client:b', 'client:c'):
+        endpoint.check_rate([key])
+    endpoint.check_rate(['client:a'])
+    endpoint.check_rate(['client:d'])
+    assert list(endpoint.buckets) == ['client:c', 'client:a', 'client:d']
+
+
+@pytest.mark.parametrize('overrides', [
+    {'rate': 0},
+    {'burst': 0},
+    {'max_in_flight': 0},
+    {'max_queue': -1}
+])
+def test_endpoint_limiter_rejects_invalid_limits(overrides):
+    with pytest.raises(ValueError):
+        make_endpoint(**overrides)
+
+
+def test_acquire_admits_until_in_flight_cap():
+    endpoint = make_endpoint()
+    assert asyncio.run(endpoint.acquire())
+    assert endpoint.snapshot()['in_flight'] == 1
+
+
+def test_acquire_queued_then_timed_out():
+    async def scenario():
+        endpoint = make_endpoint()
+        assert await endpoint.acquire()
+        started = time.monotonic()
+        assert not await endpoint.acquire()
+        assert time.monotonic() - started >= 0.05
+        return endpoint.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats['queued'] == 1
+    assert stats['shed_overloaded'] == 1
+    assert stats['waiting'] == 0
+    assert stats['in_flight'] == 1
+
+
+def test_acquire_queued_then_admitted_on_release():
+    async def scenario():
+        endpoint = make_endpoint(queue_timeout=2)
+        assert await endpoint.acquire()
+        asyncio.get_running_loop().call_later(0.05, endpoint.release, time.monotonic())
+        assert await endpoint.acquire()
+        return endpoint.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats['admitted'] == 2
+    assert stats['in_flight'] == 1
+
+
+def test_acquire_shed_when_queue_full():
+    async def scenario():
+        endpoint = make_endpoint(max_queue=0)
+        assert await endpoint.acquire()
+        assert not await endpoint.acquire()
+        return endpoint.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats['queued'] == 0
+    assert stats['shed_overloaded'] == 1
+
+
+def test_cancelled_waiter_does_not_take_a_slot():
+    async def scenario():
+        endpoint = make_endpoint(queue_timeout=2)
+        assert await endpoint.acquire()
+        waiter = asyncio.create_task(endpoint.acquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        endpoint.release(time.monotonic())
+        return endpoint.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats['in_flight'] == 0
+    assert stats['waiting'] == 0
+
+
+def test_waiter_cancelled_during_handoff_does_not_leak_the_slot():
+    async def scenario():
+        endpoint = make_endpoint(queue_timeout=2)
+        assert await endpoint.acquire()
+        waiter = asyncio.create_task(endpoint.acquire())
+        await asyncio.sleep(0)
+        # Hand the slot over, then cancel before the waiter resumes
+        endpoint.release(time.monotonic())
+        waiter.cancel()
+        [admitted] = await asyncio.gather(waiter, return_exceptions=True)
+        if admitted is True:
+            # The waiter got the slot after all, so it is the one to release it
+            endpoint.release(time.monotonic())
+        return endpoint.snapshot()
+
+    stats = asyncio.run(scenario())
+    assert stats['in_flight'] == 0
+    assert stats['waiting'] == 0
+
+
+@pytest.fixture
+def chat_endpoint(monkeypatch):
+    async def fake_process_message(message, context):
+        return {'intent': 'File New Dispute', 'response': 'ok', 'context_updates': {}}
+
+    monkeypatch.setattr(app_module, 'process_message', fake_process_message)
+    endpoint = app_module.rate_limiter.endpoints['chat']
+    for attr in ('rate', 'burst', 'max_queue', 'in_flight'):
+        monkeypatch.setattr(endpoint, attr, getattr(endpoint, attr))
+    monkeypatch.setattr(endpoint, 'buckets', type(endpoint.buckets)())
+    app_module.reset_conversation_context()
+    return endpoint
+
+
+def post_chat(*requests):
+    """Send chat requests in order through the test client; return the responses"""
+    async def send():
+        client = app_module.app.test_client()
+        responses = []
+        for headers in requests:
+            response = await client.post('/api/chat', json={'message': 'hi'}, headers=headers)
+            responses.append((response, await response.get_json()))
+        return responses
+    return asyncio.run(send())
+
+
+def test_chat_returns_429_with_retry_after(chat_endpoint):
+    chat_endpoint.rate = 0.1
+    chat_endpoint.burst = 1
+    headers = {'X-Session-ID': 'abc'}
+    (first, _), (second, body) = post_chat(headers, headers)
+    assert first.status_code == 200
+    assert second.status_code == 429
+    assert int(second.headers['Retry-After']) >= 1
+    assert body['response']
+
+
+def test_chat_returns_503_when_at_capacity(chat_endpoint):
+    chat_endpoint.max_queue = 0
+    chat_endpoint.in_flight = chat_endpoint.max_in_flight
+    [(response, body)] = post_chat({})
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    assert body['response']
+
+
+def test_slot_released_when_view_raises(chat_endpoint, monkeypatch):
+    async def failing_process_message(message, context):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(app_module, 'process_message', failing_process_message)
+    post_chat({})
+    assert chat_endpoint.snapshot()['in_flight'] == 0
+
+
+def get_metrics(remote_addr):
+    async def send():
+        client = app_module.app.test_client()
+        response = await client.get(
+            '/api/metrics',
+            headers={'Origin': 'http://evil.example'},
+            scope_base={'client': (remote_addr, 1234)}
+        )
+        return response, await response.get_json()
+    return asyncio.run(send())
+
+
+def test_metrics_only_served_to_local_clients():
+    response, body = get_metrics('127.0.0.1')
+    assert response.status_code == 200
+    assert 'chat' in body
+    assert 'Access-Control-Allow-Origin' not in response.headers
+
+    response, _ = get_metrics('203.0.113.7')
+    assert response.status_code == 404